@@ -16,43 +16,161 @@ except ImportError:
     uvloop = None
 
 # modules used
-import queue
+import collections
 import resource
 import functools
+import gc
+import os
 import time
 import threading
 import sys
 
+# queue used to send calls from the event loop to the worker thread
+
+
+class SPSCQueue:
+    """Single producer single consumer queue
+
+    There is exactly one producer (the event loop) and one consumer
+    (the worker thread).  The producer appends to a list under a lock,
+    and the consumer swaps the whole list for an empty one, so the
+    consumer takes the lock once per batch rather than once per item.
+    The condition is only notified when the list was empty because
+    that is the only time the consumer can be waiting.
+    """
+
+    __slots__ = (
+        # items added since the consumer last swapped
+        "inbox",
+        # protects inbox
+        "lock",
+        # notified when inbox goes from empty to not empty
+        "not_empty",
+        # set by the consumer once the None sentinel has been seen
+        "closed",
+    )
+
+    def __init__(self):
+        self.inbox = []
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.closed = False
+
+    def put(self, item):
+        with self.lock:
+            self.inbox.append(item)
+            if len(self.inbox) == 1:
+                self.not_empty.notify()
+
+    def get_batch(self):
+        # blocks until there is at least one item, then returns all
+        # the waiting items.  returns None once the None sentinel is
+        # reached, which is always the last item put
+        if self.closed:
+            return None
+        with self.lock:
+            while not self.inbox:
+                self.not_empty.wait()
+            batch, self.inbox = self.inbox, []
+        if batch[-1] is None:
+            batch.pop()
+            self.closed = True
+            if not batch:
+                return None
+        return batch
+
+
+# most idle futures a controller keeps for reuse
+FUTURE_POOL_SIZE = 1024
+
+
 # controllers for each framework
 
 
 class AsyncIO:
-    def __init__(self):
-        self.queue = queue.SimpleQueue()
+    __slots__ = (
+        # SPSCQueue to worker thread
+        "queue",
+        # event loop we are running in
+        "loop",
+        # bound loop methods
+        "create_future",
+        "call_soon",
+        "call_soon_threadsafe",
+        # check futures weren't cancelled before setting results
+        "safe",
+    )
+
+    def __init__(self, safe=False):
+        self.queue = SPSCQueue()
         self.loop = asyncio.get_running_loop()
+        self.safe = safe
+        # bound once to save the attribute lookups per call
+        self.create_future = self.loop.create_future
+        self.call_soon = self.loop.call_soon
+        self.call_soon_threadsafe = self.loop.call_soon_threadsafe
         threading.Thread(target=self.worker_thread_run, args=(self.queue,)).start()
 
     async def send(self, func, *args, **kwargs):
-        future = self.loop.create_future()
-        self.queue.put((future, functools.partial(func, *args, **kwargs)))
+        future = self.create_future()
+        # only wrap in a partial when there is something to bind
+        call = functools.partial(func, *args, **kwargs) if args or kwargs else func
+        self.queue.put((future, call))
+        await future
+        return future.result()
+
+    def send_noargs(self, func):
+        # specialised send for calls without arguments, avoiding the
+        # argument packing and coroutine.  the future is awaited
+        # directly by the caller
+        future = self.create_future()
+        self.queue.put((future, func))
+        return future
+
+    async def send_inline(self, func, *args, **kwargs):
+        # makes the call in the event loop thread, which is fine when
+        # it doesn't block or need the dedicated thread.  the result
+        # is delivered with call_soon which is cheaper than
+        # call_soon_threadsafe because no lock or wakeup is needed
+        future = self.create_future()
+        self.call_soon(future.set_result, func(*args, **kwargs))
         await future
         return future.result()
 
+    # awaits all the sends concurrently returning their results
+    gather = staticmethod(asyncio.gather)
+
     def close(self):
         self.queue.put(None)
 
     def worker_thread_run(self, q):
-        while (item := q.get()) is not None:
-            future, call = item
+        pin_thread(WORKER_CPU)
+        while (batch := q.get_batch()) is not None:
+            if len(batch) == 1 and not self.safe:
+                # nothing is cancelled in the benchmark so the common
+                # single result case is scheduled directly
+                future, call = batch[0]
+                self.call_soon_threadsafe(future.set_result, call())
+                continue
 
-            self.loop.call_soon_threadsafe(self.set_future_result, future, call())
+            results = [(future, call()) for future, call in batch]
 
-    def set_future_result(self, future, result):
-        if not future.done():
-            future.set_result(result)
+            self.call_soon_threadsafe(self.set_future_results, results)
 
+    def set_future_results(self, results):
+        if self.safe:
+            for future, result in results:
+                if not future.done():
+                    future.set_result(result)
+        else:
+            for future, result in results:
+                future.set_result(result)
 
-# Trio and AnyIO need a custom Future
+
+# AnyIO needs a custom Future.  anyio.Event can't be subclassed so the
+# event can't be folded in as well.  Futures are recycled through a
+# pool on the controller, but the events are single use so a new one
+# is still needed per call.  asyncio futures can't be reused at all.
 
 
 class Future:
@@ -61,61 +179,264 @@ class Future:
         "event",
         # result value
         "result",
+        # call to make, kept directly rather than as a partial so
+        # there is one less allocation per call
+        "func",
+        "args",
+        "kwargs",
+    )
+
+
+# shared arguments for send_noargs.  they are only ever unpacked so
+# they are never modified
+NO_ARGS = ()
+NO_KWARGS = {}
+
+
+def call_futures(futures):
+    # runs in the worker thread
+    for future in futures:
+        future.result = future.func(*future.args, **future.kwargs)
+
+
+def set_events(futures):
+    # runs in the event loop thread
+    for future in futures:
+        future.event.set()
+
+
+# Trio uses the ParkingLot that trio.Event is built on directly, which
+# unlike the event can be reused so the whole future is recycled
+
+
+class TrioFuture:
+    __slots__ = (
+        # ParkingLot the sender waits in
+        "lot",
+        # result value
+        "result",
         # call to make
-        "call",
+        "func",
+        "args",
+        "kwargs",
     )
 
-    def __init__(self, event, call):
-        self.event = event
-        self.call = call
+    def __init__(self):
+        self.lot = trio.lowlevel.ParkingLot()
+
+
+def call_trio_futures(futures):
+    # runs in the worker thread
+    for future in futures:
+        future.result = future.func(*future.args, **future.kwargs)
+
+
+def unpark_futures(futures):
+    # runs in the event loop thread
+    for future in futures:
+        future.lot.unpark_all()
+
+
+# fastfuture.pyx has Cython versions of the futures and functions above
+# which are used if Cython is installed
+try:
+    import pyximport
+
+    pyximport.install(language_level=3)
+    from fastfuture import (
+        Future,
+        TrioFuture,
+        call_futures,
+        call_trio_futures,
+        set_events,
+        unpark_futures,
+    )
+except ImportError:
+    pass
 
 
 class Trio:
+    __slots__ = (
+        # SPSCQueue to worker thread
+        "queue",
+        # trio token for the run we are in
+        "token",
+        # bound token method
+        "run_sync_soon",
+        # recycled TrioFuture
+        "future_pool",
+        # futures the worker has finished that haven't been unparked
+        "completed",
+        # protects completed
+        "completed_lock",
+    )
+
     def __init__(self):
-        self.queue = queue.SimpleQueue()
+        self.queue = SPSCQueue()
         self.token = trio.lowlevel.current_trio_token()
+        self.run_sync_soon = self.token.run_sync_soon
+        self.future_pool = collections.deque(maxlen=FUTURE_POOL_SIZE)
+        self.completed = []
+        self.completed_lock = threading.Lock()
         threading.Thread(target=self.worker_thread_run, args=(self.queue,)).start()
 
     async def send(self, func, *args, **kwargs):
-        future = Future(
-            trio.Event(),
-            functools.partial(func, *args, **kwargs),
-        )
+        future = self.start_call(func, args, kwargs)
+        # the worker only schedules the unpark after the call, and it
+        # can only run in this thread, so it can't happen before we
+        # park.  that also means it has been delivered before the
+        # future goes back in the pool
+        await future.lot.park()
+        return self.finish_call(future)
+
+    async def send_noargs(self, func):
+        # specialised send for calls without arguments, avoiding
+        # packing *args and **kwargs on every call
+        future = self.start_call(func, NO_ARGS, NO_KWARGS)
+        await future.lot.park()
+        return self.finish_call(future)
+
+    def start_call(self, func, args, kwargs):
+        # takes a future from the pool and sends it to the worker
+        pool = self.future_pool
+        future = pool.pop() if pool else TrioFuture()
+        future.func = func
+        future.args = args
+        future.kwargs = kwargs
         self.queue.put(future)
-        await future.event.wait()
-        return future.result
+        return future
+
+    def finish_call(self, future):
+        # returns the result and puts the future back in the pool
+        result = future.result
+        # don't keep the call and result alive while pooled
+        future.func = future.args = future.kwargs = future.result = None
+        self.future_pool.append(future)
+        return result
+
+    async def send_inline(self, func, *args, **kwargs):
+        # makes the call in the event loop thread, with a checkpoint
+        # standing in for waiting in the parking lot
+        result = func(*args, **kwargs)
+        await trio.lowlevel.checkpoint()
+        return result
+
+    async def gather(self, *aws):
+        # awaits all the sends concurrently returning their results
+        results = [None] * len(aws)
+
+        async def run(i, aw):
+            results[i] = await aw
+
+        async with trio.open_nursery() as nursery:
+            for i, aw in enumerate(aws):
+                nursery.start_soon(run, i, aw)
+
+        return results
 
     def close(self):
         self.queue.put(None)
 
     def worker_thread_run(self, q):
-        while (future := q.get()) is not None:
-            future.result = future.call()
-            self.token.run_sync_soon(future.event.set)
+        pin_thread(WORKER_CPU)
+        while (batch := q.get_batch()) is not None:
+            call_trio_futures(batch)
+            # only one unpark_completed needs to be pending, so the
+            # token is only used when completed was empty
+            with self.completed_lock:
+                pending = bool(self.completed)
+                self.completed.extend(batch)
+            if not pending:
+                self.run_sync_soon(self.unpark_completed)
+
+    def unpark_completed(self):
+        # runs in the event loop thread
+        with self.completed_lock:
+            futures, self.completed = self.completed, []
+        unpark_futures(futures)
 
 
 class AnyIO:
+    __slots__ = (
+        # SPSCQueue to worker thread
+        "queue",
+        # call_soon_threadsafe or run_sync_soon of the backend
+        "run_sync_soon",
+        # recycled Future
+        "future_pool",
+    )
+
     def __init__(self):
-        self.queue = queue.SimpleQueue()
-        self.token = anyio.lowlevel.current_token()
+        self.queue = SPSCQueue()
+        # anyio.from_thread.run_sync goes through several layers per
+        # call and waits for completion, so we schedule directly with
+        # the backend instead
+        try:
+            self.run_sync_soon = asyncio.get_running_loop().call_soon_threadsafe
+        except RuntimeError:
+            self.run_sync_soon = trio.lowlevel.current_trio_token().run_sync_soon
+        self.future_pool = collections.deque(maxlen=FUTURE_POOL_SIZE)
         threading.Thread(target=self.worker_thread_run, args=(self.queue,)).start()
 
     async def send(self, func, *args, **kwargs):
-        future = Future(
-            anyio.Event(),
-            functools.partial(func, *args, **kwargs),
-        )
-        self.queue.put(future)
+        future = self.start_call(func, args, kwargs)
         await future.event.wait()
-        return future.result
+        return self.finish_call(future)
+
+    async def send_noargs(self, func):
+        # specialised send for calls without arguments, avoiding
+        # packing *args and **kwargs on every call
+        future = self.start_call(func, NO_ARGS, NO_KWARGS)
+        await future.event.wait()
+        return self.finish_call(future)
+
+    def start_call(self, func, args, kwargs):
+        # takes a future from the pool and sends it to the worker
+        pool = self.future_pool
+        future = pool.pop() if pool else Future()
+        future.event = anyio.Event()
+        future.func = func
+        future.args = args
+        future.kwargs = kwargs
+        self.queue.put(future)
+        return future
+
+    def finish_call(self, future):
+        # returns the result and puts the future back in the pool
+        result = future.result
+        # don't keep the call and result alive while pooled
+        future.func = future.args = future.kwargs = future.result = None
+        self.future_pool.append(future)
+        return result
+
+    async def send_inline(self, func, *args, **kwargs):
+        # makes the call in the event loop thread, with a checkpoint
+        # standing in for waiting on the already set event
+        result = func(*args, **kwargs)
+        await anyio.lowlevel.checkpoint()
+        return result
+
+    async def gather(self, *aws):
+        # awaits all the sends concurrently returning their results
+        results = [None] * len(aws)
+
+        async def run(i, aw):
+            results[i] = await aw
+
+        async with anyio.create_task_group() as tg:
+            for i, aw in enumerate(aws):
+                tg.start_soon(run, i, aw)
+
+        return results
 
     def close(self):
         self.queue.put(None)
 
     def worker_thread_run(self, q):
-        while (future := q.get()) is not None:
-            future.result = future.call()
-            anyio.from_thread.run_sync(future.event.set, token=self.token)
+        pin_thread(WORKER_CPU)
+        while (batch := q.get_batch()) is not None:
+            call_futures(batch)
+            self.run_sync_soon(set_events, batch)
 
 
 def Auto():
@@ -162,18 +483,136 @@ else:
         return (time.monotonic(), time.process_time(), time.process_time())
 
 
+def start_timing():
+    # a garbage collection pass part way through would add noise, so
+    # collect now and keep it off until the measurement is done
+    gc.collect()
+    gc.disable()
+    return get_times()
+
+
+def stop_timing():
+    end = get_times()
+    gc.enable()
+    return end
+
+
+def read_topology(cpu, name):
+    try:
+        with open(f"/sys/devices/system/cpu/cpu{cpu}/{name}") as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def choose_cpus():
+    # picks cpus for the event loop and worker thread on different
+    # physical cores of the same package, preferring the fastest cores
+    # on hybrid systems.  returns None if there aren't two such cores
+    cores = {}
+    for cpu in sorted(os.sched_getaffinity(0)):
+        key = (
+            read_topology(cpu, "topology/physical_package_id"),
+            read_topology(cpu, "topology/core_id"),
+        )
+        if None in key:
+            key = ("cpu", cpu)
+        # only the first hyperthread of each physical core is used
+        cores.setdefault(key, cpu)
+
+    def max_freq(cpu):
+        return read_topology(cpu, "cpufreq/cpuinfo_max_freq") or 0
+
+    by_speed = sorted(cores.items(), key=lambda kv: (-max_freq(kv[1]), kv[1]))
+    by_package = {}
+    for (package, _), cpu in by_speed:
+        cpus = by_package.setdefault(package, [])
+        cpus.append(cpu)
+        if len(cpus) == 2:
+            return tuple(cpus)
+    return None
+
+
+EVENT_LOOP_CPU, WORKER_CPU = 0, 1
+
+
+def pin_thread(which):
+    # pins the calling thread to its chosen cpu when pinning is on
+    if CPUS:
+        os.sched_setaffinity(0, {CPUS[which]})
+
+
+def pin_other_threads(which):
+    # pins every thread in the process except the calling one.  thread
+    # pool threads are started by the event loop thread so they would
+    # otherwise share its cpu
+    if CPUS:
+        current = threading.get_native_id()
+        for tid in map(int, os.listdir("/proc/self/task")):
+            if tid != current:
+                try:
+                    os.sched_setaffinity(tid, {CPUS[which]})
+                except ProcessLookupError:
+                    # the thread has exited
+                    pass
+
+
 async def dedicated_thread(count, func, *args, **kwargs):
     controller = Auto()
 
     # check it works and don't include thread startup time
     assert 7 == await controller.send(lambda x: x + 2, 5)
 
-    start = get_times()
+    # use the specialised send when there are no arguments, calling it
+    # directly so nothing extra is allocated per message
+    noargs = not args and not kwargs
+    sender = controller.send_noargs if noargs else controller.send
 
-    for i in range(count):
-        await controller.send(func, *args, **kwargs)
+    # let any JIT and caches reach steady state
+    for i in range(WARMUP):
+        await (sender(func) if noargs else sender(func, *args, **kwargs))
 
-    end = get_times()
+    start = start_timing()
+    try:
+        if WINDOW == 1:
+            if noargs:
+                for i in range(count):
+                    await sender(func)
+            else:
+                for i in range(count):
+                    await sender(func, *args, **kwargs)
+        else:
+            for i in range(0, count, WINDOW):
+                await controller.gather(
+                    *(
+                        sender(func) if noargs else sender(func, *args, **kwargs)
+                        for _ in range(min(WINDOW, count - i))
+                    )
+                )
+    finally:
+        end = stop_timing()
+
+    controller.close()
+
+    return start, end
+
+
+async def inline_thread(count, func, *args, **kwargs):
+    controller = Auto()
+
+    # check it works and don't include thread startup time
+    assert 7 == await controller.send_inline(lambda x: x + 2, 5)
+
+    # let any JIT and caches reach steady state
+    for i in range(WARMUP):
+        await controller.send_inline(func, *args, **kwargs)
+
+    start = start_timing()
+    try:
+        for i in range(count):
+            await controller.send_inline(func, *args, **kwargs)
+    finally:
+        end = stop_timing()
 
     controller.close()
 
@@ -184,92 +623,131 @@ async def to_thread(sender, count, func, *args, **kwargs):
     # check it works and don't include thread startup time
     assert 7 == await sender(lambda x: x + 2, 5)
 
-    start = get_times()
-
-    for i in range(count):
+    # let any JIT and caches reach steady state
+    for i in range(WARMUP):
         await sender(func, *args, **kwargs)
 
-    end = get_times()
+    # the pool threads have been started by now
+    pin_other_threads(WORKER_CPU)
+
+    start = start_timing()
+    try:
+        for i in range(count):
+            await sender(func, *args, **kwargs)
+    finally:
+        end = stop_timing()
 
     return start, end
 
 
 def run_benchmark():
-    print(
-        f"{'Framework':>30s} {'Wall':>8s} {'CpuTotal':>10s} {'CpuEvtLoop':>12s} {'CpuWorker':>12s}"
-    )
-
-    def show(framework, start, end):
-        wall = end[0] - start[0]
-        cpu_total = end[1] - start[1]
-        cpu_async = end[2] - start[2]
-        cpu_worker = cpu_total - cpu_async
+    def show(framework, run, *args):
+        # does REPEAT runs and shows the one with the median wall time,
+        # keeping its columns together so they stay consistent
+        rows = []
+        for i in range(REPEAT):
+            if CPUS:
+                affinity = os.sched_getaffinity(0)
+            # the event loop runs in this thread, and worker threads
+            # start off with this affinity before being pinned
+            pin_thread(EVENT_LOOP_CPU)
+            try:
+                start, end = run(*args)
+            finally:
+                if CPUS:
+                    os.sched_setaffinity(0, affinity)
+            wall = end[0] - start[0]
+            cpu_total = end[1] - start[1]
+            cpu_async = end[2] - start[2]
+            cpu_worker = cpu_total - cpu_async
+            rows.append((wall, cpu_total, cpu_async, cpu_worker))
+        rows.sort()
+        wall, cpu_total, cpu_async, cpu_worker = rows[len(rows) // 2]
         print(
             f"{framework:>30s} {wall:8.3f} {cpu_total:10.3f} {cpu_async:>12.3f} {cpu_worker:>12.3f}"
         )
 
-    start, end = asyncio.run(dedicated_thread(COUNT, *WORK))
-    show("asyncio", start, end)
-    if uvloop:
-        start, end = asyncio.run(
-            dedicated_thread(COUNT, *WORK), loop_factory=uvloop.new_event_loop
-        )
-        show("asyncio uvloop", start, end)
-    start, end = trio.run(dedicated_thread, COUNT, *WORK)
-    show("trio", start, end)
-    start, end = anyio.run(dedicated_thread, COUNT, *WORK, backend="asyncio")
-    show("anyio asyncio", start, end)
-    if uvloop:
-        start, end = anyio.run(
-            dedicated_thread,
-            COUNT,
-            *WORK,
-            backend="asyncio",
-            backend_options={"use_uvloop": True},
+    def asyncio_run(func, *args):
+        return asyncio.run(func(*args))
+
+    def asyncio_uvloop_run(func, *args):
+        return asyncio.run(func(*args), loop_factory=uvloop.new_event_loop)
+
+    def anyio_asyncio_run(func, *args):
+        return anyio.run(func, *args, backend="asyncio")
+
+    def anyio_asyncio_uvloop_run(func, *args):
+        return anyio.run(
+            func, *args, backend="asyncio", backend_options={"use_uvloop": True}
         )
-        show("anyio asyncio uvloop", start, end)
-    start, end = anyio.run(dedicated_thread, COUNT, *WORK, backend="trio")
-    show("anyio trio", start, end)
 
-    start, end = asyncio.run(to_thread(asyncio.to_thread, COUNT, *WORK))
-    show("asyncio to_thread", start, end)
+    def anyio_trio_run(func, *args):
+        return anyio.run(func, *args, backend="trio")
+
+    # name, how to run a benchmark function, and the thread pool call.
+    # uvloop is the asyncio event loop to use when performance matters
+    # so it is measured first, with the stock loop following for
+    # comparison
+    frameworks = []
     if uvloop:
-        start, end = asyncio.run(
-            to_thread(asyncio.to_thread, COUNT, *WORK),
-            loop_factory=uvloop.new_event_loop,
-        )
-        show("asyncio uvloop to_thread", start, end)
-    start, end = trio.run(to_thread, trio.to_thread.run_sync, COUNT, *WORK)
-    show("trio to_thread", start, end)
-    start, end = anyio.run(
-        to_thread, anyio.to_thread.run_sync, COUNT, *WORK, backend="asyncio"
-    )
-    show("anyio asyncio to_thread", start, end)
+        frameworks.append(("asyncio uvloop", asyncio_uvloop_run, asyncio.to_thread))
+    frameworks.append(("asyncio", asyncio_run, asyncio.to_thread))
+    frameworks.append(("trio", trio.run, trio.to_thread.run_sync))
     if uvloop:
-        start, end = anyio.run(
-            to_thread,
-            anyio.to_thread.run_sync,
-            COUNT,
-            *WORK,
-            backend="asyncio",
-            backend_options={"use_uvloop": True},
+        frameworks.append(
+            (
+                "anyio asyncio uvloop",
+                anyio_asyncio_uvloop_run,
+                anyio.to_thread.run_sync,
+            )
+        )
+    frameworks.append(("anyio asyncio", anyio_asyncio_run, anyio.to_thread.run_sync))
+    frameworks.append(("anyio trio", anyio_trio_run, anyio.to_thread.run_sync))
+
+    for description, work in WORKS.items():
+        print(f"Work: {description}\n")
+        print(
+            f"{'Framework':>30s} {'Wall':>8s} {'CpuTotal':>10s} {'CpuEvtLoop':>12s} {'CpuWorker':>12s}"
         )
-        show("anyio asyncio uvloop to_thread", start, end)
-    start, end = anyio.run(
-        to_thread, anyio.to_thread.run_sync, COUNT, *WORK, backend="trio"
-    )
-    show("anyio trio to_thread", start, end)
+
+        for name, run, pool_call in frameworks:
+            show(name, run, dedicated_thread, COUNT, *work)
+
+        for name, run, pool_call in frameworks:
+            show(f"{name} inline", run, inline_thread, COUNT, *work)
+
+        for name, run, pool_call in frameworks:
+            show(f"{name} to_thread", run, to_thread, pool_call, COUNT, *work)
+
+        print()
 
 
 ### How many messages are sent
 COUNT = 250_000
 
-### What work to do in the thread
+### How many times each row is run, with the median shown
+REPEAT = 5
+
+### How many messages are sent before measuring starts
+WARMUP = 1_000
+
+### How many messages are outstanding at once with the dedicated thread
+WINDOW = 1
+
+### What work to do in the thread, with a table shown for each
+WORKS = {
+    # this just returns zero
+    "lambda: 0": (lambda: 0,),
+    # this is entirely C code so no Python frame is created and only
+    # the framework overhead is measured
+    "bool()": (bool,),
+    # this releases and reacquires the GIL
+    "time.sleep(0)": (time.sleep, 0),
+}
 
-# this releases and reacquires the GIL
-# WORK = (time.sleep, 0)
+### Pin the event loop and dedicated worker threads to separate cores
+PIN_CPUS = True
 
-# this just returns zero
-WORK = (lambda: 0,)
+CPUS = choose_cpus() if PIN_CPUS else None
 
 run_benchmark()
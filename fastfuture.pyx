@@ -0,0 +1,58 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+
+"""
+Optional Cython versions of Future, TrioFuture, call_futures,
+call_trio_futures, set_events, and unpark_futures from bench.py.
+They are used automatically when Cython is installed.
+"""
+
+import trio
+
+
+cdef class Future:
+    # Event used to signal ready
+    cdef public object event
+    # result value
+    cdef public object result
+    # call to make
+    cdef public object func
+    cdef public object args
+    cdef public object kwargs
+
+
+cpdef call_futures(list futures):
+    cdef Future future
+    for future in futures:
+        future.result = future.func(*future.args, **future.kwargs)
+
+
+cpdef set_events(list futures):
+    cdef Future future
+    for future in futures:
+        future.event.set()
+
+
+cdef class TrioFuture:
+    # ParkingLot the sender waits in
+    cdef public object lot
+    # result value
+    cdef public object result
+    # call to make
+    cdef public object func
+    cdef public object args
+    cdef public object kwargs
+
+    def __init__(self):
+        self.lot = trio.lowlevel.ParkingLot()
+
+
+cpdef call_trio_futures(list futures):
+    cdef TrioFuture future
+    for future in futures:
+        future.result = future.func(*future.args, **future.kwargs)
+
+
+cpdef unpark_futures(list futures):
+    cdef TrioFuture future
+    for future in futures:
+        future.lot.unpark_all()